@@ -6,11 +6,67 @@ AI食物过敏预警器 - 核心检测引擎
 
 import re
 import json
-from typing import List, Dict
+import functools
+import threading
+from array import array
+from bisect import bisect_right
+from typing import Collection, List, Dict, Sequence
 from dataclasses import dataclass
 from enum import Enum
 import sqlite3
 import os
+import pickle
+import sys
+import tempfile
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+# 长连接上启用的 SQLite 性能参数
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+)
+
+# 数据库与 pickle 缓存的默认目录（仓库根目录下的 data/），不随当前工作目录变化。
+# 缓存用 pickle 加载，能写入该目录的人即可在进程内执行代码，因此它只能对受信任的用户可写
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+# 过敏原缓存格式版本，基础数据或缓存结构变化时递增
+_BUILD_VERSION = 7
+
+# 成分清理用的预编译正则
+_RE_HEADER = re.compile(r"(?:ingredients?|contains?|may contain|配料表?|成分表?|原料)[:：]\s*", re.IGNORECASE)
+# 括号注释和开头的 "contains"/"may contain"/"+" 一次替换掉（输入已 casefold）
+_RE_CLEAN = re.compile(r"(?P<paren>\([^)]*\))|(?P<pref>^(?:contains\*?|may contain|\+)\s*)")
+_RE_SEP = re.compile(r"[,，;；、\n]\s*")
+
+# 删除数字和百分号（含全角），str.translate 在短字符串上比正则更快
+_DIGIT_TBL = str.maketrans("", "", "0123456789%０１２３４５６７８９％")
+
+# 不视为有效成分的通用词（casefold、驻留）
+_STOP_WORDS = frozenset(sys.intern(word.casefold()) for word in (
+    "ingredients", "成分", "原料", "材料", "contains", "含有",
+    "water", "水", "salt", "盐", "sugar", "糖", "oil", "油",
+    "natural", "自然", "artificial", "人工", "flavor", "风味",
+    "preservative", "防腐剂", "color", "色素", "vitamin", "维生素"
+))
+
+
+@functools.lru_cache(maxsize=4096)
+def _clean_ingredient(ingredient: str) -> str:
+    """清理单个（已 casefold 的）成分；常见成分在不同标签间大量重复，结果按输入缓存"""
+    ingredient = ingredient.translate(_DIGIT_TBL).strip()
+    ingredient = _RE_CLEAN.sub("", ingredient).strip()
+    
+    if ingredient in _STOP_WORDS:
+        return ""
+        
+    return ingredient
 
 
 class RiskLevel(Enum):
@@ -35,6 +91,52 @@ class AllergenType(Enum):
     SULFITES = "sulfites"
 
 
+# 过敏原类型索引的固定前缀；数据库中的其他类型在加载时依次追加。索引存为 int8，最多 128 种
+_BASE_TYPES = tuple(allergen_type.value for allergen_type in AllergenType)
+_MAX_TYPES = 128
+
+
+# 严重度统一截断到 0..10（综合严重度本身也以 10 封顶），保证能装进 int8
+_MAX_SEVERITY = 10
+
+
+def _clamp_severity(severity) -> int:
+    """把用户或数据库给出的严重度截断到 0.._MAX_SEVERITY"""
+    return max(0, min(int(severity or 0), _MAX_SEVERITY))
+
+
+@dataclass
+class DetectedAllergens:
+    """检测到的过敏原（结构数组布局）
+    
+    type_idx 为 int8 类型索引（见 AllergenDatabase.type_names），severity 为截断到
+    0..10 的 int8 数组，二者供风险评估使用；types 和 db_severity 保留数据库中的原始值用于展示
+    """
+    names: List[str]
+    types: List[str]
+    matched_ingredients: List[str]
+    type_idx: array
+    severity: array
+    db_severity: List[int]
+    
+    def __len__(self) -> int:
+        return len(self.names)
+        
+    def to_dicts(self) -> List[Dict]:
+        """转换为对外返回的字典列表"""
+        return [
+            {
+                "name": name,
+                "type": allergen_type,
+                "severity": severity,
+                "matched_ingredient": matched_ingredient
+            }
+            for name, allergen_type, severity, matched_ingredient in zip(
+                self.names, self.types, self.db_severity, self.matched_ingredients
+            )
+        ]
+
+
 @dataclass
 class DetectionResult:
     """检测结果"""
@@ -47,18 +149,35 @@ class DetectionResult:
 
 
 class AllergenDatabase:
-    """过敏原数据库"""
+    """过敏原数据库
     
-    def __init__(self, db_path: str = "data/allergen_db.sqlite"):
-        self.db_path = db_path
-        self._init_database()
+    db_path 默认为 DATA_DIR 下的 allergen_db.sqlite，cache_path 默认与之同名、扩展名为 .pkl；
+    缓存文件必须来自受信任的来源
+    """
+    
+    def __init__(self, db_path: str = None, cache_path: str = None):
+        self.db_path = db_path or os.path.join(DATA_DIR, "allergen_db.sqlite")
+        self.cache_path = cache_path or os.path.splitext(self.db_path)[0] + ".pkl"
+        self.conn = None
+        self._match_names = functools.lru_cache(maxsize=4096)(self._match_names)
+        
+        if not self._load_cache():
+            self._init_database()
+            self._load_rows()
+            # 运行时不再查询 SQLite；先关闭连接完成 WAL 检查点，缓存记录的修改时间才稳定
+            self.close()
+            self._build_automaton()
+            self._save_cache()
         
     def _init_database(self):
         """初始化数据库"""
         os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        for pragma in SQLITE_PRAGMAS:
+            self.conn.execute(pragma)
+            
+        cursor = self.conn.cursor()
         
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS allergens (
@@ -67,229 +186,516 @@ class AllergenDatabase:
                 type TEXT,
                 severity INTEGER,
                 aliases TEXT,
-                languages TEXT
+                languages TEXT,
+                exclusions TEXT
             )
         """)
         
+        # 旧数据库没有 exclusions 列
+        columns = {row[1] for row in cursor.execute("PRAGMA table_info(allergens)")}
+        if "exclusions" not in columns:
+            cursor.execute("ALTER TABLE allergens ADD COLUMN exclusions TEXT")
+        
         self._populate_base_data()
-        conn.commit()
-        conn.close()
         
     def _populate_base_data(self):
-        """填充基础过敏原数据"""
+        """填充基础过敏原数据
+        
+        exclusions 列出包含该过敏原别名、但本身不含该过敏原的词（如 eggplant 中的 egg），
+        别名命中完全落在这些词内时不计
+        """
         base_allergens = [
-            ("peanuts", "peanut", 5, "peanut,groundnut,arachis hypogaea,花生,落花生", "en:peanuts,zh:花生"),
-            ("milk", "dairy", 3, "milk,dairy,lactose,casein,奶,牛奶,乳制品", "en:milk,zh:牛乳"),
-            ("gluten", "gluten", 3, "gluten,wheat,flour,麸质,小麦,面粉", "en:gluten,zh:麸质"),
-            ("shrimp", "shellfish", 5, "shrimp,prawn,crustacean,虾,海鲜", "en:shrimp,zh:虾"),
-            ("eggs", "egg", 3, "egg,ovalbumin,ovomucoid,蛋,鸡蛋", "en:eggs,zh:鸡蛋")
+            ("peanuts", "peanut", 5, "peanut,groundnut,arachis hypogaea,花生,落花生", "en:peanuts,zh:花生",
+             "peanut-free,花生四烯酸"),
+            ("milk", "dairy", 3, "milk,dairy,lactose,casein,奶,牛奶,乳制品", "en:milk,zh:牛乳",
+             "coconut milk,almond milk,oat milk,soy milk,rice milk,dairy-free,dairy free,椰奶,椰子奶,豆奶,杏仁奶,燕麦奶"),
+            ("gluten", "gluten", 3, "gluten,wheat,flour,麸质,小麦,面粉", "en:gluten,zh:麸质",
+             "buckwheat,buckwheat flour,rice flour,corn flour,cornflour,potato flour,tapioca flour,"
+             "coconut flour,almond flour,chickpea flour,gluten-free,gluten free,无麸质,不含麸质"),
+            ("shrimp", "shellfish", 5, "shrimp,prawn,crustacean,虾,海鲜", "en:shrimp,zh:虾", ""),
+            ("eggs", "egg", 3, "egg,ovalbumin,ovomucoid,蛋,鸡蛋", "en:eggs,zh:鸡蛋",
+             "eggplant,egg-free,鸡蛋果,蛋白质,大豆蛋白,豌豆蛋白,乳清蛋白")
         ]
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        cursor = self.conn.cursor()
+        cursor.execute("BEGIN")
         
         for allergen in base_allergens:
             try:
                 cursor.execute("""
-                    INSERT OR IGNORE INTO allergens 
-                    (name, type, severity, aliases, languages)
-                    VALUES (?, ?, ?, ?, ?)
+                    INSERT INTO allergens 
+                    (name, type, severity, aliases, languages, exclusions)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(name) DO UPDATE SET exclusions = excluded.exclusions
+                    WHERE allergens.exclusions IS NULL
                 """, allergen)
             except sqlite3.IntegrityError:
                 continue
                 
-        conn.commit()
-        conn.close()
+        cursor.execute("COMMIT")
         
     def search_allergens(self, ingredient: str) -> List[Dict]:
         """搜索成分中的过敏原"""
-        ingredient = ingredient.lower().strip()
+        allergens = []
+        for name in self._match_names(ingredient.casefold().strip()):
+            record = self._rows[name]
+            allergens.append({
+                **record,
+                "aliases": list(record["aliases"]),
+                "languages": dict(record["languages"]),
+                "exclusions": list(record["exclusions"])
+            })
+            
+        return allergens
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def _match_names(self, ingredient: str) -> tuple:
+        """返回成分（已 casefold）中命中的过敏原名称，按首次命中顺序去重
         
-        cursor.execute("""
-            SELECT name, type, severity, aliases, languages FROM allergens
-            WHERE LOWER(name) LIKE ? OR LOWER(aliases) LIKE ?
-        """, (f"%{ingredient}%", f"%{ingredient}%"))
+        在 __init__ 中按实例包装为 LRU 缓存，缓存值为不可变的名称元组
+        """
+        names = []
+        seen_names: set[str] = set()
+        for _, (name, *_) in self._iter_hits(ingredient):
+            if name not in seen_names:
+                seen_names.add(name)
+                names.append(name)
+        return tuple(names)
         
+    def _db_mtime(self):
+        """数据库文件的修改时间，用于判断缓存是否过期"""
+        try:
+            return os.stat(self.db_path).st_mtime_ns
+        except OSError:
+            return None
+            
+    def _load_cache(self) -> bool:
+        """从 pickle 缓存加载已构建的别名数据，缓存缺失或过期时返回 False
+        
+        pickle.load 会执行缓存中的任意代码，cache_path 必须位于只有受信任用户可写的目录
+        """
+        # 缓存文件可能被截断、损坏或来自其他版本，任何异常都视为缓存失效并重建
+        try:
+            with open(self.cache_path, "rb") as f:
+                cache = pickle.load(f)
+                
+            if not isinstance(cache, dict):
+                return False
+            if cache.get("version") != _BUILD_VERSION or cache.get("db_mtime") != self._db_mtime():
+                return False
+                
+            rows = cache["rows"]
+            alias_payload = cache["alias_payload"]
+            type_names = cache["type_names"]
+            automaton = cache["automaton"]
+            if not isinstance(rows, dict) or not isinstance(alias_payload, dict) or not isinstance(type_names, list):
+                return False
+        except Exception:
+            return False
+            
+        self._rows = rows
+        self._alias_payload = alias_payload
+        self.type_names = type_names
+        self._automaton = automaton
+        self._alias_regex = None
+        if self._automaton is None:
+            self._build_automaton()
+        return True
+        
+    def _save_cache(self):
+        """原子地写入 pickle 缓存，写入失败不影响检测"""
+        cache = {
+            "version": _BUILD_VERSION,
+            "db_mtime": self._db_mtime(),
+            "rows": self._rows,
+            "alias_payload": self._alias_payload,
+            "type_names": self.type_names,
+            "automaton": self._automaton
+        }
+        
+        cache_dir = os.path.dirname(self.cache_path) or "."
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        except OSError:
+            return
+            
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+            # mkstemp 以 0600 创建，放宽为 0644，其他用户的进程也能读到缓存
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.cache_path)
+        except Exception:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            
+    def _load_rows(self):
+        """一次性从 SQLite 读出全部过敏原及其别名
+        
+        SQLite 只作为持久化格式，运行时查询全部走内存中的别名 trie
+        """
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT name, type, severity, aliases, languages, exclusions FROM allergens")
         rows = cursor.fetchall()
         
-        allergens = []
-        for row in rows:
-            allergens.append({
-                "name": row[0],
-                "type": row[1],
-                "severity": row[2],
-                "aliases": row[3].split(",") if row[3] else [],
-                "languages": row[4] if row[4] else {}
-            })
+        self._rows = {}
+        # 类型索引：AllergenType 的值在前，数据库中其他自由文本类型按出现顺序追加
+        self.type_names = list(_BASE_TYPES)
+        type_index = {allergen_type: i for i, allergen_type in enumerate(self.type_names)}
+        # 词条 -> [过敏原记录或 None, 以该词条为排除词的过敏原名称集合]
+        entries = {}
+        for name, allergen_type, severity, aliases, languages, exclusions in rows:
+            # languages 形如 "en:peanuts,zh:花生"，加载时解析为 {"en": "peanuts", "zh": "花生"}
+            self._rows[name] = {
+                "name": name,
+                "type": allergen_type,
+                "severity": severity,
+                "aliases": aliases.split(",") if aliases else [],
+                "languages": dict(
+                    pair.split(":", 1) for pair in languages.split(",") if ":" in pair
+                ) if languages else {},
+                "exclusions": exclusions.split(",") if exclusions else []
+            }
             
-        conn.close()
-        return allergens
+            if allergen_type not in type_index:
+                if len(self.type_names) >= _MAX_TYPES:
+                    raise ValueError(f"过敏原类型超过 {_MAX_TYPES} 种，无法用 int8 索引")
+                type_index[allergen_type] = len(self.type_names)
+                self.type_names.append(allergen_type)
+                
+            record = (name, allergen_type, severity, type_index[allergen_type])
+            terms = [name] + (aliases.split(",") if aliases else [])
+            for term in terms:
+                term = term.casefold().strip()
+                if term:
+                    entries.setdefault(term, [None, set()])[0] = record
+            for term in self._rows[name]["exclusions"]:
+                term = term.casefold().strip()
+                if term:
+                    entries.setdefault(term, [None, set()])[1].add(name)
+                    
+        # 载荷为 (词条长度, 过敏原记录或 None, 排除的过敏原名称)，自动机和正则回退共用
+        self._alias_payload = {
+            term: (len(term), record, frozenset(excluded_names))
+            for term, (record, excluded_names) in entries.items()
+        }
+                    
+    def _build_automaton(self):
+        """用全部别名和排除词构建 Aho-Corasick 自动机
+        
+        未安装 pyahocorasick 时退化为所有别名的单条正则并集
+        """
+        self._automaton = None
+        self._alias_regex = None
+        if ahocorasick is not None:
+            self._automaton = ahocorasick.Automaton()
+            for term, payload in self._alias_payload.items():
+                self._automaton.add_word(term, payload)
+            self._automaton.make_automaton()
+        else:
+            # 别名已在加载时折叠大小写，无需 (?i)。零宽前瞻让每个起点都尝试匹配，
+            # 长别名优先取到该起点最长的别名，再由 _alias_prefixes 补上同一起点的较短别名，
+            # 从而与 Aho-Corasick 一样产出全部（含重叠的）命中
+            terms = sorted(self._alias_payload, key=len, reverse=True)
+            self._alias_regex = re.compile("(?=(" + "|".join(re.escape(term) for term in terms) + "))")
+            self._alias_prefixes = {
+                term: [term[:i] for i in range(1, len(term) + 1) if term[:i] in self._alias_payload]
+                for term in terms
+            }
+            
+    def _iter_hits(self, text: str):
+        """逐个产出 (命中结束位置, 过敏原记录)，text 须已 casefold
+        
+        完全落在该过敏原某个排除词范围内的别名命中会被丢弃。
+        自动机/正则构建后只读，可被多个线程同时遍历
+        """
+        hits = []
+        excluded = []
+        for end, (length, record, excluded_names) in self._iter_matches(text):
+            if record is not None:
+                hits.append((end - length + 1, end, record))
+            if excluded_names:
+                excluded.append((end - length + 1, end, excluded_names))
+                
+        for start, end, record in hits:
+            if excluded and any(
+                record[0] in excluded_names and ex_start <= start and end <= ex_end
+                for ex_start, ex_end, excluded_names in excluded
+            ):
+                continue
+            yield end, record
+            
+    def _iter_matches(self, text: str):
+        """产出全部（含重叠的）词条命中 (结束位置, 词条载荷)，包括排除词"""
+        if self._automaton is not None:
+            yield from self._automaton.iter(text)
+            return
+            
+        hits = []
+        for match in self._alias_regex.finditer(text):
+            start = match.start()
+            for term in self._alias_prefixes[match.group(1)]:
+                hits.append((start + len(term) - 1, -len(term), term))
+                
+        # 与自动机的产出顺序一致：按结束位置升序，同一位置长词条在前
+        hits.sort()
+        for end, _, term in hits:
+            yield end, self._alias_payload[term]
+        
+    def scan_raw(self, text: str) -> List[Dict]:
+        """对整段（已清理、已 casefold 的）标签文本做单次扫描，不依赖成分拆分
+        
+        matched_ingredient 取命中位置所在的、按成分分隔符切出的片段，
+        并按 extract_ingredients 的规则清理，与 result.ingredients 中的条目一致
+        """
+        starts = [0]
+        ends = []
+        for match in _RE_SEP.finditer(text):
+            ends.append(match.start())
+            starts.append(match.end())
+        ends.append(len(text))
+        
+        hits = []
+        for end, (name, allergen_type, severity, type_idx) in self._iter_hits(text):
+            i = bisect_right(starts, end) - 1
+            fragment = text[starts[i]:ends[i]].strip()
+            hits.append({
+                "name": name,
+                "type": allergen_type,
+                "type_idx": type_idx,
+                "severity": severity,
+                "matched_ingredient": _clean_ingredient(fragment) or fragment
+            })
+        return hits
+        
+    def close(self):
+        """关闭数据库连接"""
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
 
 
 class IngredientProcessor:
     """成分处理器"""
     
-    def __init__(self):
-        self.separators = r"[,，;；、\n]\s*"
-        self.stop_words = {
-            "ingredients", "成分", "原料", "材料", "contains", "含有",
-            "water", "水", "salt", "盐", "sugar", "糖", "oil", "油",
-            "natural", "自然", "artificial", "人工", "flavor", "风味",
-            "preservative", "防腐剂", "color", "色素", "vitamin", "维生素"
-        }
-        
     def extract_ingredients(self, text: str) -> List[str]:
         """从文本中提取成分列表"""
         if not text:
             return []
             
-        text = self._clean_text(text)
-        ingredients = re.split(self.separators, text)
+        return self.split_ingredients(self.clean_text(text))
         
+    def split_ingredients(self, text: str, keep: Collection[str] = ()) -> List[str]:
+        """把已经过 clean_text 的文本拆成成分列表
+        
+        单字成分默认丢弃；keep 中的成分（如含过敏原命中的片段，取值同 scan_raw 的
+        matched_ingredient）总是保留
+        """
         cleaned_ingredients = []
-        for ingredient in ingredients:
+        for ingredient in _RE_SEP.split(text):
             cleaned = self._clean_ingredient(ingredient)
             if cleaned and len(cleaned) > 1:
                 cleaned_ingredients.append(cleaned)
-                
+            elif keep:
+                fragment = cleaned or ingredient.casefold().strip()
+                if fragment in keep:
+                    cleaned_ingredients.append(fragment)
+                    
         return cleaned_ingredients
         
-    def _clean_text(self, text: str) -> str:
+    def clean_text(self, text: str) -> str:
         """清理文本"""
-        text = re.sub(r"\s+", " ", text)
-        
-        patterns_to_remove = [
-            r"ingredients?[:：]\s*",
-            r"contains?[:：]\s*",
-            r"may contain[:：]\s*"
-        ]
-        
-        for pattern in patterns_to_remove:
-            text = re.sub(pattern, "", text, flags=re.IGNORECASE)
-            
+        text = " ".join(text.split())
+        text = _RE_HEADER.sub("", text)
         return text.strip()
         
     def _clean_ingredient(self, ingredient: str) -> str:
         """清理单个成分"""
-        ingredient = ingredient.lower().strip()
-        ingredient = re.sub(r"\d+%?", "", ingredient)
-        ingredient = re.sub(r"\([^)]*\)", "", ingredient)
-        
-        prefixes_to_remove = ["contains", "contains*", "may contain", "+"]
-        for prefix in prefixes_to_remove:
-            if ingredient.startswith(prefix):
-                ingredient = ingredient[len(prefix):].strip()
-                
-        if ingredient in self.stop_words:
-            return ""
-            
-        return ingredient
+        return _clean_ingredient(ingredient.casefold().strip())
+
+
+# 内部使用的整数风险等级，只在对外返回时转换为 RiskLevel
+_LOW, _MOD, _HIGH, _SEV = 0, 1, 2, 3
+_RISK_LEVELS = (RiskLevel.LOW, RiskLevel.MODERATE, RiskLevel.HIGH, RiskLevel.SEVERE)
+
+
+def _combined_risk(combined_severity: int) -> int:
+    """综合严重度 -> 整数风险等级（_LOW ... _SEV）"""
+    if combined_severity >= 8:
+        return _SEV
+    if combined_severity >= 6:
+        return _HIGH
+    if combined_severity >= 4:
+        return _MOD
+    return _LOW
 
 
 class RiskAssessor:
     """风险评估器"""
     
-    def __init__(self, user_allergens: Dict[str, int] = None):
+    def __init__(self, user_allergens: Dict[str, int] = None, type_names: Sequence[str] = _BASE_TYPES):
         self.user_allergens = user_allergens or {}
         
-    def assess_risk(self, detected_allergens: List[Dict]) -> RiskLevel:
+        # 类型索引 -> 截断后的用户敏感度，-1 表示不过敏；type_names 须与产生检测结果的数据库一致
+        user_sev = {
+            allergen_type: _clamp_severity(user_severity)
+            for allergen_type, user_severity in self.user_allergens.items()
+        }
+        self._user_sev = array("b", (user_sev.get(allergen_type, -1) for allergen_type in type_names))
+        
+    def assess_risk(self, detected: DetectedAllergens) -> RiskLevel:
         """评估过敏风险等级"""
-        if not detected_allergens:
-            return RiskLevel.LOW
-            
-        max_risk = RiskLevel.LOW
+        return _RISK_LEVELS[self.assess_risk_index(detected)]
         
-        for allergen in detected_allergens:
-            if allergen["type"] in self.user_allergens:
-                user_severity = self.user_allergens[allergen["type"]]
-                allergen_severity = allergen["severity"]
-                
-                combined_severity = min(user_severity + allergen_severity, 10)
+    def assess_risk_index(self, detected: DetectedAllergens) -> int:
+        """评估过敏风险等级，返回整数等级（_LOW ... _SEV）"""
+        user_sev = self._user_sev
+        max_risk = _LOW
+        for type_idx, severity in zip(detected.type_idx, detected.severity):
+            user_severity = user_sev[type_idx]
+            if user_severity < 0:
+                continue
                 
-                if combined_severity >= 8:
-                    max_risk = RiskLevel.SEVERE
-                elif combined_severity >= 6:
-                    max_risk = RiskLevel.HIGH
-                elif combined_severity >= 4:
-                    max_risk = RiskLevel.MODERATE
+            risk = _combined_risk(min(user_severity + severity, 10))
+            if risk > max_risk:
+                max_risk = risk
+                if max_risk == _SEV:
+                    break
                     
         return max_risk
         
-    def generate_warnings(self, detected_allergens: List[Dict]) -> List[str]:
+    def assess_risk_batch(self, detections: List[DetectedAllergens]) -> List[int]:
+        """批量评估多个产品的风险，返回整数等级列表"""
+        return [self.assess_risk_index(detected) for detected in detections]
+        
+    def generate_warnings(self, detected: DetectedAllergens) -> List[str]:
         """生成警告信息"""
         warnings = []
         
-        for allergen in detected_allergens:
-            if allergen["type"] in self.user_allergens:
-                user_severity = self.user_allergens[allergen["type"]]
+        for name, type_idx, severity in zip(detected.names, detected.type_idx, detected.severity):
+            user_severity = self._user_sev[type_idx]
+            if user_severity < 0:
+                continue
+                
+            if user_severity >= 4 and severity >= 4:
+                warnings.append(f"⚠️ 严重警告：检测到{name}，可能导致严重过敏反应")
+            elif user_severity >= 3 or severity >= 3:
+                warnings.append(f"🔔 警告：检测到{name}，需谨慎食用")
+            else:
+                warnings.append(f"💡 提醒：检测到{name}，轻度过敏原")
                 
-                if user_severity >= 4 and allergen["severity"] >= 4:
-                    warnings.append(f"⚠️ 严重警告：检测到{allergen[\"name\"]}，可能导致严重过敏反应")
-                elif user_severity >= 3 or allergen["severity"] >= 3:
-                    warnings.append(f"🔔 警告：检测到{allergen[\"name\"]}，需谨慎食用")
-                else:
-                    warnings.append(f"💡 提醒：检测到{allergen[\"name\"]}，轻度过敏原")
-                    
         return warnings
 
 
 class AllergenDetector:
-    """过敏原检测器主类"""
+    """过敏原检测器主类
+    
+    构建完成后只读（别名自动机、查找表均不再修改），可安全地在多线程间共享；
+    但检测全程持有 GIL，多线程并不能提速
+    """
     
     def __init__(self, user_allergens: Dict[str, int] = None):
         self.ingredient_processor = IngredientProcessor()
         self.allergen_db = AllergenDatabase()
-        self.risk_assessor = RiskAssessor(user_allergens)
+        self.risk_assessor = RiskAssessor(user_allergens, self.allergen_db.type_names)
         
     def scan_text(self, text: str) -> DetectionResult:
-        """直接分析文本"""
-        ingredients = self.ingredient_processor.extract_ingredients(text)
-        return self._analyze_ingredients(ingredients)
+        """直接分析文本
         
-    def _analyze_ingredients(self, ingredients: List[str]) -> DetectionResult:
-        """分析成分列表中的过敏原"""
-        detected_allergens = []
-        found_ingredients = []
+        过敏原检测对整段原文做一次扫描；成分拆分只用于展示和置信度计算
+        """
+        ingredients, hits = self._scan_label(text)
+        return self._analyze_hits(ingredients, hits)
         
-        for ingredient in ingredients:
-            found_ingredients.append(ingredient)
-            
-            matching_allergens = self.allergen_db.search_allergens(ingredient)
+    def scan_batch(self, texts: List[str]) -> List[DetectionResult]:
+        """依次分析多段文本，结果顺序与输入一致
+        
+        便捷接口：逐段检测后统一调用 assess_risk_batch 评估风险。检测持有 GIL，
+        这里不使用线程；需要多核时请在进程池中每个进程各建一个检测器
+        """
+        batch = []
+        for text in texts:
+            ingredients, hits = self._scan_label(text)
+            batch.append((ingredients, self._collect_hits(hits)))
             
-            for allergen in matching_allergens:
-                if not any(a["type"] == allergen["type"] for a in detected_allergens):
-                    detected_allergens.append({
-                        "name": allergen["name"],
-                        "type": allergen["type"],
-                        "severity": allergen["severity"],
-                        "matched_ingredient": ingredient
-                    })
+        risks = self.risk_assessor.assess_risk_batch([detected for _, detected in batch])
+        return [
+            self._build_result(ingredients, detected, risk)
+            for (ingredients, detected), risk in zip(batch, risks)
+        ]
         
-        risk_level = self.risk_assessor.assess_risk(detected_allergens)
-        warnings = self.risk_assessor.generate_warnings(detected_allergens)
+    def _scan_label(self, text: str):
+        """清理一次标签文本，对其做一次过敏原扫描，再拆出成分列表
         
-        confidence = self._calculate_confidence(detected_allergens, ingredients)
-        safe = risk_level == RiskLevel.LOW and len(detected_allergens) == 0
+        含命中的片段即使只有一个字也保留在成分列表中，保证每个 matched_ingredient 都在其中
+        """
+        cleaned = self.ingredient_processor.clean_text(text) if text else ""
+        hits = self.allergen_db.scan_raw(cleaned.casefold())
+        ingredients = self.ingredient_processor.split_ingredients(
+            cleaned, {allergen["matched_ingredient"] for allergen in hits}
+        )
+        return ingredients, hits
+        
+    def _analyze_hits(self, ingredients: List[str], hits: List[Dict]) -> DetectionResult:
+        """汇总过敏原命中，评估风险并生成检测结果"""
+        detected = self._collect_hits(hits)
+        risk = self.risk_assessor.assess_risk_index(detected)
+        return self._build_result(ingredients, detected, risk)
+        
+    def _collect_hits(self, hits: List[Dict]) -> DetectedAllergens:
+        """按过敏原类型去重，整理为结构数组布局"""
+        names = []
+        types = []
+        matched_ingredients = []
+        type_idx = array("b")
+        severity = array("b")
+        db_severity = []
+        seen_types: set[int] = set()
+        
+        for allergen in hits:
+            if allergen["type_idx"] not in seen_types:
+                seen_types.add(allergen["type_idx"])
+                names.append(allergen["name"])
+                types.append(allergen["type"])
+                matched_ingredients.append(allergen["matched_ingredient"])
+                type_idx.append(allergen["type_idx"])
+                severity.append(_clamp_severity(allergen["severity"]))
+                db_severity.append(allergen["severity"])
+                
+        return DetectedAllergens(
+            names=names,
+            types=types,
+            matched_ingredients=matched_ingredients,
+            type_idx=type_idx,
+            severity=severity,
+            db_severity=db_severity
+        )
+        
+    def _build_result(self, ingredients: List[str], detected: DetectedAllergens, risk: int) -> DetectionResult:
+        """由检测结果和整数风险等级生成对外的 DetectionResult"""
+        warnings = self.risk_assessor.generate_warnings(detected)
+        
+        confidence = self._calculate_confidence(detected, ingredients)
+        safe = risk == _LOW and len(detected) == 0
+        risk_level = _RISK_LEVELS[risk]
         
         return DetectionResult(
-            ingredients=found_ingredients,
-            detected_allergens=detected_allergens,
+            ingredients=list(ingredients),
+            detected_allergens=detected.to_dicts(),
             risk_level=risk_level,
             confidence=confidence,
             safe=safe,
             warnings=warnings
         )
         
-    def _calculate_confidence(self, detected_allergens: List[Dict], ingredients: List[str]) -> float:
+    def _calculate_confidence(self, detected: DetectedAllergens, ingredients: List[str]) -> float:
         """计算检测置信度"""
         if not ingredients:
             return 0.0
             
         total_ingredients = len(ingredients)
-        matched_ingredients = len(detected_allergens)
+        matched_ingredients = len(detected)
         
         if matched_ingredients > 0:
             confidence = 0.6 + (matched_ingredients / total_ingredients) * 0.4
@@ -302,6 +708,26 @@ class AllergenDetector:
         return min(confidence, 1.0)
 
 
+# 进程内共享的默认检测器（无个人过敏档案），首次使用时创建
+_DETECTOR = None
+_DETECTOR_LOCK = threading.Lock()
+
+
+def get_detector() -> AllergenDetector:
+    """获取共享的默认检测器"""
+    global _DETECTOR
+    if _DETECTOR is None:
+        with _DETECTOR_LOCK:
+            if _DETECTOR is None:
+                _DETECTOR = AllergenDetector()
+    return _DETECTOR
+
+
+def scan_batch(texts: List[str]) -> List[DetectionResult]:
+    """用共享的默认检测器依次分析多段文本"""
+    return get_detector().scan_batch(texts)
+
+
 def main():
     """主函数，测试过敏原检测功能"""
     user_allergens = {
@@ -326,7 +752,7 @@ def main():
     print(f"检测到的过敏原: {result.detected_allergens}")
     print(f"风险等级: {result.risk_level.value}")
     print(f"置信度: {result.confidence:.2f}")
-    print(f"是否安全: {\"✅ 安全\" if result.safe else \"❌ 不安全\"}")
+    print(f"是否安全: {'✅ 安全' if result.safe else '❌ 不安全'}")
     
     if result.warnings:
         print(f"\n⚠️ 警告信息:")
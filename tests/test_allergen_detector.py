@@ -0,0 +1,329 @@
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import allergen_detector
+from allergen_detector import AllergenDatabase, AllergenDetector, RiskLevel
+
+
+ENGLISH_LABEL = """
+Ingredients:
+Wheat flour, sugar, peanuts, milk powder, salt,
+natural flavors, shrimp powder, preservatives
+"""
+
+CHINESE_LABEL = "配料：小麦粉，白砂糖，花生(20%)，鸡蛋，食用盐"
+
+
+@pytest.fixture(params=["automaton", "regex"])
+def backend(request, tmp_path, monkeypatch):
+    """数据目录指向临时目录，分别覆盖 Aho-Corasick 与未安装 pyahocorasick 时的正则回退"""
+    monkeypatch.setattr(allergen_detector, "DATA_DIR", str(tmp_path / "data"))
+    if request.param == "automaton":
+        if allergen_detector.ahocorasick is None:
+            pytest.skip("pyahocorasick not installed")
+    else:
+        monkeypatch.setattr(allergen_detector, "ahocorasick", None)
+    return request.param
+
+
+@pytest.fixture
+def database(backend):
+    db = AllergenDatabase()
+    if backend == "regex":
+        assert db._automaton is None
+    return db
+
+
+@pytest.fixture
+def detector(backend):
+    return AllergenDetector({"peanut": 5, "shellfish": 3, "dairy": 2, "egg": 3})
+
+
+def _data_file(name):
+    return os.path.join(allergen_detector.DATA_DIR, name)
+
+
+def _types(result):
+    return {allergen["type"] for allergen in result.detected_allergens}
+
+
+def test_scan_text_english(detector):
+    result = detector.scan_text(ENGLISH_LABEL)
+
+    assert _types(result) == {"gluten", "peanut", "dairy", "shellfish"}
+    assert result.risk_level is RiskLevel.SEVERE
+    assert not result.safe
+    for allergen in result.detected_allergens:
+        assert allergen["matched_ingredient"] in result.ingredients
+    assert 0.0 <= result.confidence <= 1.0
+
+
+def test_scan_text_chinese(detector):
+    result = detector.scan_text(CHINESE_LABEL)
+
+    assert _types(result) == {"gluten", "peanut", "egg"}
+    matched = {allergen["type"]: allergen["matched_ingredient"] for allergen in result.detected_allergens}
+    assert matched == {"gluten": "小麦粉", "peanut": "花生", "egg": "鸡蛋"}
+    assert result.risk_level is RiskLevel.SEVERE
+    assert 0.0 <= result.confidence <= 1.0
+
+
+@pytest.mark.parametrize("label, ingredients", [
+    ("配料：虾，蛋", ["虾", "蛋"]),
+    ("配料：虾，蛋，小麦粉，盐", ["虾", "蛋", "小麦粉"]),
+    ("Ingredients: sugar, (contains milk)", ["(contains milk)"]),
+])
+def test_every_hit_is_listed(detector, label, ingredients):
+    result = detector.scan_text(label)
+
+    assert result.ingredients == ingredients
+    for allergen in result.detected_allergens:
+        assert allergen["matched_ingredient"] in result.ingredients
+
+
+def test_label_is_cleaned_once(detector, monkeypatch):
+    calls = []
+    clean_text = allergen_detector.IngredientProcessor.clean_text
+
+    def counting_clean_text(self, text):
+        calls.append(text)
+        return clean_text(self, text)
+
+    monkeypatch.setattr(allergen_detector.IngredientProcessor, "clean_text", counting_clean_text)
+    detector.scan_text(ENGLISH_LABEL)
+
+    assert calls == [ENGLISH_LABEL]
+
+
+def test_case_folding_matches_ingredients(detector):
+    result = detector.scan_text("Ingredients: Weißbrot peanuts, salt")
+
+    assert result.ingredients == ["weissbrot peanuts"]
+    assert result.detected_allergens[0]["matched_ingredient"] == "weissbrot peanuts"
+    assert result.confidence == 1.0
+
+
+@pytest.mark.parametrize("label, expected", [
+    ("water, salt", RiskLevel.LOW),
+    ("wheat flour", RiskLevel.LOW),
+    ("milk powder", RiskLevel.MODERATE),
+    ("鸡蛋", RiskLevel.HIGH),
+    ("配料：虾，盐", RiskLevel.SEVERE),
+])
+def test_risk_levels(detector, label, expected):
+    assert detector.scan_text(label).risk_level is expected
+
+
+def _add_allergen(name, allergen_type, severity, aliases, languages=""):
+    """向临时数据库插入一行；修改数据库会使 pickle 缓存失效"""
+    AllergenDatabase().close()
+    conn = sqlite3.connect(_data_file("allergen_db.sqlite"))
+    conn.execute("INSERT INTO allergens (name, type, severity, aliases, languages) VALUES (?, ?, ?, ?, ?)",
+                 (name, allergen_type, severity, aliases, languages))
+    conn.commit()
+    conn.close()
+
+
+def test_free_text_allergen_type(backend):
+    _add_allergen("mustard", "mustard", 4, "mustard,芥末")
+    detector = AllergenDetector({"mustard": 4})
+
+    result = detector.scan_text("配料：芥末，盐")
+
+    assert detector.allergen_db.type_names[-1] == "mustard"
+    assert [allergen["type"] for allergen in result.detected_allergens] == ["mustard"]
+    assert result.risk_level is RiskLevel.SEVERE
+
+
+def test_out_of_range_severities_are_clamped(backend):
+    _add_allergen("sesame", "sesame", 300, "sesame")
+    detector = AllergenDetector({"peanut": 500, "sesame": -20})
+
+    peanut = detector.scan_text("peanuts")
+    sesame = detector.scan_text("sesame")
+
+    assert peanut.risk_level is RiskLevel.SEVERE
+    assert sesame.risk_level is RiskLevel.SEVERE
+    # 对外返回数据库中的原始严重度，截断只用于风险评估
+    assert sesame.detected_allergens[0]["severity"] == 300
+
+
+def test_assess_risk_batch_matches_single(detector):
+    labels = [ENGLISH_LABEL, CHINESE_LABEL, "water, salt", "milk powder", "鸡蛋", ""]
+    detections = [detector._collect_hits(detector._scan_label(label)[1]) for label in labels]
+    assessor = detector.risk_assessor
+
+    assert assessor.assess_risk_batch(detections) == [assessor.assess_risk_index(d) for d in detections]
+    assert assessor.assess_risk_batch([]) == []
+
+
+@pytest.mark.parametrize("ingredient, expected", [
+    ("Peanut Butter", ["peanuts"]),
+    ("wheat flour", ["gluten"]),
+    ("milk powder", ["milk"]),
+    ("落花生油", ["peanuts"]),
+    ("鸡蛋", ["eggs"]),
+    ("牛奶", ["milk"]),
+    ("white sugar", []),
+])
+def test_search_allergens(database, ingredient, expected):
+    assert [allergen["name"] for allergen in database.search_allergens(ingredient)] == expected
+
+
+@pytest.mark.parametrize("ingredient, expected", [
+    ("eggplant", []),
+    ("rice flour", []),
+    ("buckwheat flour", []),
+    ("gluten-free oats", []),
+    ("coconut milk", []),
+    ("椰奶", []),
+    ("大豆蛋白", []),
+    ("wheat flour, rice flour", ["gluten"]),
+    ("鸡蛋白质", ["eggs"]),
+])
+def test_search_allergens_exclusions(database, ingredient, expected):
+    assert [allergen["name"] for allergen in database.search_allergens(ingredient)] == expected
+
+
+def test_scan_text_ignores_excluded_terms(detector):
+    result = detector.scan_text("Ingredients: eggplant, rice flour, coconut milk, 椰奶, salt")
+
+    assert result.detected_allergens == []
+    assert result.safe
+
+
+def test_exclusions_added_to_existing_database(backend):
+    os.makedirs(allergen_detector.DATA_DIR)
+    conn = sqlite3.connect(_data_file("allergen_db.sqlite"))
+    conn.execute("""
+        CREATE TABLE allergens (
+            id INTEGER PRIMARY KEY, name TEXT UNIQUE, type TEXT,
+            severity INTEGER, aliases TEXT, languages TEXT
+        )
+    """)
+    conn.execute("INSERT INTO allergens (name, type, severity, aliases, languages) "
+                 "VALUES ('eggs', 'egg', 3, 'egg,蛋', 'en:eggs')")
+    conn.commit()
+    conn.close()
+
+    db = AllergenDatabase()
+
+    assert db.search_allergens("eggplant") == []
+    assert db.search_allergens("egg")[0]["aliases"] == ["egg", "蛋"]
+
+
+def test_regex_fallback_matches_automaton(tmp_path, monkeypatch):
+    if allergen_detector.ahocorasick is None:
+        pytest.skip("pyahocorasick not installed")
+    text = "落花生油 peanuts, eggplant, egg, wheat flour, rice flour, 鸡蛋白质"
+
+    automaton_db = AllergenDatabase(str(tmp_path / "aho" / "allergen_db.sqlite"))
+    monkeypatch.setattr(allergen_detector, "ahocorasick", None)
+    regex_db = AllergenDatabase(str(tmp_path / "regex" / "allergen_db.sqlite"))
+
+    assert list(regex_db._iter_hits(text)) == list(automaton_db._iter_hits(text))
+
+
+def test_corrupt_cache_is_rebuilt(backend):
+    AllergenDatabase()
+    with open(_data_file("allergen_db.pkl"), "wb") as f:
+        f.write(b"not a pickle")
+
+    db = AllergenDatabase()
+
+    assert [allergen["name"] for allergen in db.search_allergens("peanuts")] == ["peanuts"]
+
+
+def test_cache_lives_in_data_dir(backend, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    db = AllergenDatabase()
+
+    assert db.cache_path == _data_file("allergen_db.pkl")
+    assert os.stat(db.cache_path).st_mode & 0o777 == 0o644
+    assert not os.path.exists(tmp_path / "allergen_db.pkl")
+    assert [name for name in os.listdir(allergen_detector.DATA_DIR) if name.endswith(".tmp")] == []
+
+
+def test_failed_cache_write_leaves_no_temp_file(backend, monkeypatch):
+    def fail_replace(src, dst):
+        raise OSError("read-only")
+
+    monkeypatch.setattr(allergen_detector.os, "replace", fail_replace)
+    db = AllergenDatabase()
+
+    assert not os.path.exists(db.cache_path)
+    assert [name for name in os.listdir(allergen_detector.DATA_DIR) if name.endswith(".tmp")] == []
+    assert [allergen["name"] for allergen in db.search_allergens("peanuts")] == ["peanuts"]
+
+
+def test_scan_batch_matches_scan_text(detector):
+    labels = [ENGLISH_LABEL, CHINESE_LABEL, "water, salt", "", "配料：虾，蛋"]
+
+    assert detector.scan_batch(labels) == [detector.scan_text(label) for label in labels]
+    assert detector.scan_batch([]) == []
+
+
+def test_shared_detector(backend, monkeypatch):
+    monkeypatch.setattr(allergen_detector, "_DETECTOR", None)
+    labels = [ENGLISH_LABEL, CHINESE_LABEL] * 20
+
+    detector = allergen_detector.get_detector()
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        threaded = list(pool.map(detector.scan_text, labels))
+
+    assert allergen_detector.get_detector() is detector
+    assert allergen_detector.scan_batch(labels) == threaded
+
+
+def test_languages_parsed_into_dict(database):
+    peanuts = database.search_allergens("peanuts")[0]
+    assert peanuts["languages"] == {"en": "peanuts", "zh": "花生"}
+
+    # 返回的是副本，修改不影响后续查询
+    peanuts["languages"]["fr"] = "arachide"
+    peanuts["aliases"].append("arachide")
+    again = database.search_allergens("peanuts")[0]
+    assert again["languages"] == {"en": "peanuts", "zh": "花生"}
+    assert "arachide" not in again["aliases"]
+
+
+def test_languages_skip_malformed_pairs(backend):
+    _add_allergen("mustard", "mustard", 4, "mustard", "en:mustard,broken,zh:芥末")
+    _add_allergen("celery", "celery", 3, "celery")
+    db = AllergenDatabase()
+
+    assert db.search_allergens("mustard")[0]["languages"] == {"en": "mustard", "zh": "芥末"}
+    assert db.search_allergens("celery")[0]["languages"] == {}
+
+
+def test_search_allergens_is_memoized(database):
+    database.search_allergens("peanuts")
+    hits = database._match_names.cache_info().hits
+
+    # 查询在 casefold/strip 之后才进入缓存，大小写和空白不同的写法共用同一条目
+    database.search_allergens(" Peanuts ")
+
+    assert database._match_names.cache_info().hits == hits + 1
+    assert database._match_names.cache_info().currsize == 1
+
+
+def test_match_cache_is_per_database(backend, tmp_path):
+    first = AllergenDatabase()
+    second = AllergenDatabase(str(tmp_path / "other" / "allergen_db.sqlite"))
+    first.search_allergens("milk")
+
+    assert first._match_names.cache_info().currsize == 1
+    assert second._match_names.cache_info().currsize == 0
+
+
+def test_clean_ingredient_is_memoized(detector):
+    detector.scan_text(ENGLISH_LABEL)
+    hits = allergen_detector._clean_ingredient.cache_info().hits
+
+    result = detector.scan_text(ENGLISH_LABEL)
+
+    assert allergen_detector._clean_ingredient.cache_info().hits > hits
+    assert result == detector.scan_text(ENGLISH_LABEL)